@@ -1,28 +1,176 @@
 from dataclasses import dataclass
 from datetime import datetime as dt
 from datetime import timedelta as td
+from joblib import Parallel, delayed
+from joblib import dump as jdump, load as jload
 from pathlib import Path
 from sklearn.decomposition import PCA
+from sklearn.base import BaseEstimator, ClassifierMixin, TransformerMixin
 from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
-from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.metrics import classification_report, confusion_matrix
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import train_test_split, HalvingGridSearchCV
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.preprocessing import LabelEncoder, StandardScaler
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
 import numpy as np
-import numpy.random as random
 import os
 import pandas as pd
-import pickle
 import pybaseball as bball
 import tempfile
 
+try:
+    import lz4  # noqa: F401
+    _COMPRESS = ('lz4', 3)
+except ImportError:
+    _COMPRESS = ('zlib', 3)
+
+try:
+    import hnswlib
+    _HAS_HNSW = True
+except ImportError:
+    _HAS_HNSW = False
+
+try:
+    import onnxruntime
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+    _HAS_ONNX = True
+except ImportError:
+    _HAS_ONNX = False
+
+try:
+    import cudf
+    from cuml.ensemble import RandomForestClassifier as cuRFC
+    _HAS_CUML = True
+except ImportError:
+    _HAS_CUML = False
+
+try:
+    from numba import njit
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
 bball.cache.enable()
 
 random_state = 42
+pitches = ['4-Seam Fastball', 'Changeup', 'Curveball', 'Cutter', 'Sinker', 'Slider']
+serial_predict_rows = 10_000
+onnx_max_nodes = 10_000_000
 tmpdir = f'{tempfile.gettempdir()}/PitchGuesser'
 if not os.path.exists(tmpdir):
     os.mkdir(tmpdir)
 
+datadir = os.path.join(Path(__file__).parent.absolute(), 'data')
+_COLS = pd.read_csv(os.path.join(datadir, 'cols.csv'), header=None).iloc[:, 0].tolist()
+
+# cleaned frames already built in this process, keyed by (start_dt, end_dt, refresh)
+_clean_cache = {}
+
+class ANNClassifier(BaseEstimator, ClassifierMixin):
+    """Approximate nearest neighbor classifier backed by an hnswlib HNSW index"""
+
+    def __init__(self, n_neighbors=10, ef=100, M=16, ef_construction=200, n_jobs=-1):
+        self.n_neighbors = n_neighbors
+        self.ef = ef
+        self.M = M
+        self.ef_construction = ef_construction
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        self.classes_, self._y = np.unique(y, return_inverse=True)
+        # hnswlib measures l2 in float32, past this bound squared differences overflow to inf
+        # (the scaled experiment gets there), so fall back to sklearn's exact search
+        limit = np.sqrt(np.finfo(np.float32).max / X.shape[1]) / 2
+        if np.abs(X).max() > limit:
+            self._exact = KNeighborsClassifier(n_neighbors=self.n_neighbors, n_jobs=self.n_jobs).fit(X, self._y)
+            self._index = None
+            return self
+        self._exact = None
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self._index = hnswlib.Index(space='l2', dim=X.shape[1])
+        self._index.init_index(max_elements=len(X), ef_construction=self.ef_construction, M=self.M)
+        self._index.add_items(X, np.arange(len(X)), num_threads=self.n_jobs)
+        return self
+
+    def predict(self, X):
+        if self._exact is not None:
+            return self.classes_[self._exact.predict(np.asarray(X, dtype=np.float64))]
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        # ef has to cover k or the index can't return enough neighbors
+        self._index.set_ef(max(self.ef, self.n_neighbors))
+        labels, _ = self._index.knn_query(X, k=self.n_neighbors, num_threads=self.n_jobs)
+        votes = self._y[labels.astype(np.intp)]
+        counts = (votes[..., None] == np.arange(len(self.classes_))).sum(axis=1)
+        return self.classes_[counts.argmax(axis=1)]
+
+_neighbor_models = (KNeighborsClassifier, ANNClassifier)
+
+def _append_mags(X, pairs, triples):
+    n, d = X.shape
+    out = np.empty((n, d + pairs.shape[0] + triples.shape[0]), dtype=X.dtype)
+    for r in range(n):
+        for c in range(d):
+            out[r, c] = X[r, c]
+        k = d
+        for p in range(pairs.shape[0]):
+            a = X[r, pairs[p, 0]]
+            b = X[r, pairs[p, 1]]
+            out[r, k] = np.sqrt(a * a + b * b)
+            k += 1
+        for t in range(triples.shape[0]):
+            a = X[r, triples[t, 0]]
+            b = X[r, triples[t, 1]]
+            c = X[r, triples[t, 2]]
+            out[r, k] = np.sqrt(a * a + b * b + c * c)
+            k += 1
+    return out
+
+if _HAS_NUMBA:
+    _append_mags = njit(cache=True)(_append_mags)
+
+class MagTransformer(BaseEstimator, TransformerMixin):
+    """Appends the magnitude of paired and tripled feature columns, given by name or position"""
+
+    def __init__(
+        self,
+        pairs=(('plate_x', 'plate_z'), ('release_pos_x', 'release_pos_z'), ('pfx_x', 'pfx_z')),
+        triples=(('ax', 'ay', 'az'), ('vx0', 'vy0', 'vz0'))
+    ):
+        self.pairs = pairs
+        self.triples = triples
+
+    def fit(self, X, y=None):
+        cols = getattr(X, 'columns', None)
+        cols = None if cols is None else list(cols)
+        self.n_features_in_ = np.shape(X)[1]
+        self.pairs_idx_ = np.array([self.__positions(pair, cols) for pair in self.pairs], dtype=np.intp)
+        self.triples_idx_ = np.array([self.__positions(tri, cols) for tri in self.triples], dtype=np.intp)
+        return self
+
+    def __positions(self, group, cols):
+        idx = []
+        for c in group:
+            if isinstance(c, (int, np.integer)):
+                idx.append(int(c))
+            elif cols is None:
+                raise ValueError(f'Column {c!r} given by name but X has no column names')
+            else:
+                idx.append(cols.index(c))
+        return idx
+
+    def transform(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f'X has {X.shape[1]} features, but MagTransformer was fitted with {self.n_features_in_}')
+        if _HAS_NUMBA:
+            return _append_mags(X, self.pairs_idx_, self.triples_idx_)
+        mags = [np.hypot(X[:, i], X[:, j]) for i, j in self.pairs_idx_]
+        mags += [np.linalg.norm(X[:, tri], axis=1) for tri in self.triples_idx_]
+        return np.column_stack([X] + mags)
+
 @dataclass
 class PitchData:
     """Class for modeling pitch types"""
@@ -31,67 +179,91 @@ class PitchData:
     refresh: bool = False
 
     def __post_init__(self):
-        pdir = Path(__file__).parent.absolute()
-        self.datadir = os.path.join(pdir, 'data')
+        self.datadir = datadir
         self.__pkl = f"{tmpdir}/pitch_data.pkl"
-        self.pitches = ['4-Seam Fastball', 'Changeup', 'Curveball', 'Cutter', 'Sinker', 'Slider']
+        self.__clean_pkl = f"{tmpdir}/pitch_clean_{self.start_dt}_{self.end_dt}.parquet"
+        self.pitches = list(pitches)
         self.__start_ts = dt.strptime(self.start_dt, "%Y-%m-%d")
         self.__end_ts = dt.strptime(self.end_dt, "%Y-%m-%d")
         self.raw_data = self.__get_data()
 
     def __get_from_date(self, df):
         if self.__start_ts < df.game_date.min():
-            new_days = bball.statcast(
+            return bball.statcast(
                 start_dt=self.start_dt,
                 end_dt=dt.strftime(df.game_date.min(), "%Y-%m-%d"),
                 verbose=False
             )
-            if not new_days.empty:
-                df = pd.concat([df, new_days])
-        return df
+        return None
 
     def __get_to_date(self, df):
         if self.__end_ts > df.game_date.max() + td(days=1):
-            new_days = bball.statcast(
+            return bball.statcast(
                 start_dt=dt.strftime(df.game_date.max() + td(days=1), "%Y-%m-%d"),
                 end_dt=self.end_dt,
                 verbose=False
             )
-            if not new_days.empty:
-                df = pd.concat([df, new_days])
-        return df
+        return None
 
     def __clean_data(self, df):
         df = df.dropna(subset=['release_speed', 'release_pos_x', 'release_pos_z'])
         df.to_pickle(self.__pkl)
         df = self.__split_cat(df)
         df = self.__get_cols(df)
-        df = df.fillna(method='ffill')
+        df = df.ffill()
         # most common pitches
-        df = df.loc[df.pitch_name.isin(self.pitches), :].sort_values(by=['pitch_name', 'game_date', 'pitcher'])
-        return df.loc[(df['game_date'] >= self.__start_ts) & (df['game_date'] <= self.__end_ts), :]
+        mask = df.pitch_name.isin(self.pitches) & df.game_date.between(self.__start_ts, self.__end_ts)
+        df = df.loc[mask, :].sort_values(by=['pitch_name', 'game_date', 'pitcher'])
+        df = self.__downcast(df)
+        df.to_parquet(self.__clean_pkl)
+        return df
+
+    def __downcast(self, df):
+        for c in df.select_dtypes('float64').columns:
+            df[c] = df[c].astype(np.float32)
+        for c in df.select_dtypes('int64').columns:
+            df[c] = pd.to_numeric(df[c], downcast='integer')
+        for c in ('pitch_name', 'player_name', 'p_throws', 'type'):
+            if c in df:
+                df[c] = df[c].astype('category')
+        return df
 
     def __split_cat(self, df):
-        df2 = df.copy()
-        df2['lefty'] = df.p_throws == 'L'
-        df2['righty'] = df.p_throws == 'R'
-        df2['ball'] = df.type == 'B'
-        df2['strike'] = df.type == 'S'
-        df2['hit_in_play'] = df.type == 'X'
-        return df2
+        # shallow copy shares the data buffers, only the new columns are allocated
+        df = df.copy(deep=False)
+        p = df.p_throws.values
+        t = df.type.values
+        df['lefty'] = p == 'L'
+        df['righty'] = p == 'R'
+        df['ball'] = t == 'B'
+        df['strike'] = t == 'S'
+        df['hit_in_play'] = t == 'X'
+        return df
 
     def __get_data(self):
+        key = (self.start_dt, self.end_dt, self.refresh)
+        if key not in _clean_cache:
+            if os.path.exists(self.__clean_pkl) and not self.refresh:
+                _clean_cache[key] = pd.read_parquet(self.__clean_pkl)
+            else:
+                _clean_cache[key] = self.__load_data()
+        # shallow copy so column assignments on one instance don't leak into the cache
+        return _clean_cache[key].copy(deep=False)
+
+    def __load_data(self):
         if os.path.exists(self.__pkl) and not self.refresh:
             df = pd.read_pickle(self.__pkl)
         else:
             df = bball.statcast(self.start_dt, self.end_dt)
-        df = self.__get_from_date(df)
-        df = self.__get_to_date(df)
+        # collect the missing days and concat once
+        parts = [df, self.__get_from_date(df), self.__get_to_date(df)]
+        parts = [part for part in parts if part is not None and not part.empty]
+        if len(parts) > 1:
+            df = pd.concat(parts, ignore_index=True)
         return self.__clean_data(df)
 
     def __get_cols(self, df):
-        cols = pd.read_csv(f"{self.datadir}/cols.csv", header=None).squeeze().to_list()
-        return df[cols]
+        return df[_COLS]
 
 @dataclass
 class PitchModelBuild(PitchData):
@@ -99,6 +271,8 @@ class PitchModelBuild(PitchData):
     model_pkl = None
     test_size: float = 0.30
     experiment: int = 0
+    # same encoding LabelEncoder would give, the pitch list is already sorted
+    _LABEL_MAP = {name: i for i, name in enumerate(pitches)}
 
     def __post_init__(self):
         super(PitchModelBuild, self).__post_init__()
@@ -106,6 +280,7 @@ class PitchModelBuild(PitchData):
             raise ValueError('A model must be passed')
         if self.model_pkl is None:
             raise ValueError('A model pickle file must be passed')
+        self._rng = np.random.default_rng(random_state)
         self.features = self.__feature_types()
         self.__splitter()
         self.__fit()
@@ -143,22 +318,19 @@ class PitchModelBuild(PitchData):
     def __experiment(self, X):
         if self.experiment == 1:
             self.model_pkl = self.__get_exp_model_path('scaled')
-            i = 1
-            for j, col in enumerate(X.columns):
-                if j % 3 == 0:
-                    i += 1
-                    X[col] = X[col] + i
-                elif j % 3 == 1:
-                    X[col] = X[col] * i
-                elif j % 3 == 2:
-                    X[col] = X[col] ** i
+            arr = X.to_numpy(dtype=np.float64, copy=True)
+            idx = np.arange(arr.shape[1])
+            # every third column bumps the coefficient, starting at 2
+            coef = 2 + idx // 3
+            m0, m1, m2 = idx % 3 == 0, idx % 3 == 1, idx % 3 == 2
+            arr[:, m0] += coef[m0]
+            arr[:, m1] *= coef[m1]
+            arr[:, m2] = np.power(arr[:, m2], coef[m2])
+            X = pd.DataFrame(arr, index=X.index, columns=X.columns)
         elif self.experiment == 2:
             self.model_pkl = self.__get_exp_model_path('add_feature')
-            X['plate_mag'] = np.sqrt(X.plate_x**2 + X.plate_z**2)
-            X['release_pos_mag'] = np.sqrt(X.release_pos_x**2 + X.release_pos_z**2)
-            X['pfx_mag'] = np.sqrt(X.pfx_x**2 + X.pfx_z**2)
-            X['a_mag'] = np.sqrt(X.ax**2 + X.ay**2 + X.az**2)
-            X['v0_mag'] = np.sqrt(X.vx0**2 + X.vy0**2 + X.vz0**2)
+            # magnitudes are appended inside the model so X is never copied here
+            self.model = Pipeline([('mag', MagTransformer()), ('clf', self.model)])
         elif self.experiment == 3:
             self.model_pkl = self.__get_exp_model_path('preprocess')
             X_cat = X[self.features['categorical']].copy()
@@ -172,8 +344,10 @@ class PitchModelBuild(PitchData):
             X = StandardScaler().fit_transform(X_num)
         elif self.experiment == 5:
             self.model_pkl = self.__get_exp_model_path('random')
-            X['random_cont'] = [random.uniform(100, 300) for _ in range(len(X))]
-            X['random_desc'] = random.randint(1, 6, len(X))
+            X = X.copy(deep=False)
+            n = len(X)
+            X['random_cont'] = self._rng.uniform(100, 300, n)
+            X['random_desc'] = self._rng.integers(1, 6, n)
         return X
 
     def __set_x_y(self):
@@ -186,11 +360,11 @@ class PitchModelBuild(PitchData):
             'type',
         )
 
-        X = self.raw_data.loc[:, ~self.raw_data.columns.isin(skip_cols)].copy()
-        X = self.__experiment(X)
-        le = LabelEncoder()
-        y = self.raw_data.pitch_name
-        y = le.fit_transform(y)
+        # no explicit copy here, the float32 cast below already makes one
+        keep = [c for c in self.raw_data.columns if c not in skip_cols]
+        X = self.raw_data[keep]
+        X = self.__experiment(X).astype(np.float32)
+        y = self.raw_data.pitch_name.map(self._LABEL_MAP).to_numpy(dtype=np.int8)
 
         return X, y
 
@@ -212,13 +386,44 @@ class PitchModelBuild(PitchData):
             self.X_test = pd.DataFrame(pca.transform(self.X_test))
 
     def __fit(self):
-        if not os.path.exists(self.model_pkl) or self.refresh:
-            self.model.fit(self.X_train, self.y_train)
-            with open(self.model_pkl, 'wb') as fout:
-                pickle.dump(self.model, fout)
+        fitted = not os.path.exists(self.model_pkl) or self.refresh
+        if fitted:
+            y_train = self.y_train
+            if _on_gpu(_best_estimator(self.model)):
+                y_train = cudf.Series(y_train.astype(np.int32))
+            self.model.fit(_model_input(self.model, self.X_train), y_train)
+            jdump(self.model, self.model_pkl, compress=_COMPRESS)
         else:
-            with open(self.model_pkl, 'rb') as fin:
-                self.model = pickle.load(fin)
+            self.model = jload(self.model_pkl)
+        self.model_onnx = self.__export_onnx(fitted)
+
+    def __export_onnx(self, fitted):
+        est = _best_estimator(self.model)
+        # no worthwhile converter for neighbors or the custom feature step, those stay on sklearn
+        if not _HAS_ONNX or isinstance(self.model, Pipeline) or isinstance(est, _neighbor_models) or _on_gpu(est):
+            return None
+        onnx_path = f"{os.path.splitext(self.model_pkl)[0]}.onnx"
+        # protobuf can't serialize past 2GB, big forests stay on sklearn
+        if _node_count(est) > onnx_max_nodes:
+            return self.__drop_onnx(onnx_path)
+        if fitted or not os.path.exists(onnx_path):
+            try:
+                onx = convert_sklearn(
+                    est,
+                    initial_types=[('X', FloatTensorType([None, self.X_train.shape[1]]))],
+                    options={id(est): {'zipmap': False}}
+                )
+                with open(onnx_path, 'wb') as fout:
+                    fout.write(onx.SerializeToString())
+            except Exception:
+                return self.__drop_onnx(onnx_path)
+        return onnx_path
+
+    def __drop_onnx(self, onnx_path):
+        # never leave an export from an older fit behind
+        if os.path.exists(onnx_path):
+            os.remove(onnx_path)
+        return None
 
 @dataclass
 class PitchGuessPost(PitchModelBuild):
@@ -232,7 +437,31 @@ class PitchGuessPost(PitchModelBuild):
         self.score = self.__score()
 
     def __prediction(self):
-        return self.model.predict(self.X_test)
+        if self.model_onnx is not None:
+            sess = onnxruntime.InferenceSession(self.model_onnx, providers=['CPUExecutionProvider'])
+            return sess.run(None, {'X': np.asarray(self.X_test, dtype=np.float32)})[0]
+        est = _best_estimator(self.model)
+        # pipelines carry their own feature steps, predict through the whole chain
+        predictor = self.model if isinstance(self.model, Pipeline) else est
+        X_test = _model_input(predictor, self.X_test)
+        if _on_gpu(est):
+            y_predict = predictor.predict(X_test)
+            return y_predict.to_numpy() if hasattr(y_predict, 'to_numpy') else y_predict
+        # single threaded estimator, parallelism (if any) comes from chunking the rows
+        has_jobs = hasattr(est, 'n_jobs')
+        if has_jobs:
+            n_jobs, est.n_jobs = est.n_jobs, 1
+        try:
+            if len(X_test) < serial_predict_rows:
+                return predictor.predict(X_test)
+            chunks = np.array_split(np.arange(len(X_test)), os.cpu_count() or 1)
+            preds = Parallel(n_jobs=-1, prefer='threads')(
+                delayed(predictor.predict)(X_test.take(chunk, axis=0)) for chunk in chunks
+            )
+            return np.concatenate(preds)
+        finally:
+            if has_jobs:
+                est.n_jobs = n_jobs
 
     def __get_cm(self):
         return pd.DataFrame(
@@ -242,48 +471,100 @@ class PitchGuessPost(PitchModelBuild):
         )
 
     def __score(self):
-        return accuracy_score(self.y_test, self.y_predict)
+        # correct predictions sit on the diagonal
+        return np.trace(self.cm.values) / self.cm.values.sum()
 
     def class_report(self):
         return pd.DataFrame(classification_report(self.y_test, self.y_predict, output_dict=True))
 
-def _get_grid_search(model, params):
-    return GridSearchCV(
-        model,
-        params,
-        cv=2,
-        n_jobs=-1,
-        verbose=1,
-        scoring='f1_micro'
-    )
+def _best_estimator(model):
+    if isinstance(model, Pipeline):
+        model = model[-1]
+    return model.best_estimator_ if hasattr(model, 'best_estimator_') else model
+
+def _node_count(model):
+    # forests keep a flat list of trees, boosting a 2d array of them
+    return sum(tree.tree_.node_count for tree in np.ravel(getattr(model, 'estimators_', [])))
+
+def _on_gpu(model):
+    return _HAS_CUML and isinstance(model, cuRFC)
+
+def _model_input(model, X):
+    if isinstance(model, Pipeline):
+        return X
+    if _on_gpu(model):
+        return cudf.DataFrame.from_pandas(X)
+    # neighbor searches scan every row, hand them a contiguous float32 block
+    if isinstance(getattr(model, 'estimator', model), _neighbor_models):
+        return np.ascontiguousarray(X, dtype=np.float32)
+    return X
+
+def _get_grid_search(model, params, **kwargs):
+    search = {
+        'cv': 2,
+        'n_jobs': -1,
+        'factor': 3,
+        'resource': 'n_samples',
+        'verbose': 1,
+        'scoring': 'f1_micro',
+    }
+    search.update(kwargs)
+    return HalvingGridSearchCV(model, params, **search)
 
 @dataclass
 class PitchRFC(PitchGuessPost):
+    # n_estimators is the halving resource rather than a grid axis
     __params = {
-        'n_estimators': [100, 200, 500],
         'criterion': ['gini', 'entropy']
     }
     model_name = 'Random Forest'
-    model = _get_grid_search(RandomForestClassifier(random_state=random_state), __params)
-    model_pkl = f'{tmpdir}/RFC.pkl'
+    if _HAS_CUML and os.environ.get('PITCHGUESSER_GPU'):
+        model = cuRFC(n_estimators=500, n_streams=4, random_state=random_state)
+        model_pkl = f'{tmpdir}/RFC_gpu.joblib'
+    else:
+        model = _get_grid_search(
+            RandomForestClassifier(
+                random_state=random_state,
+                n_jobs=-1,
+                max_samples=0.5,
+                max_features='sqrt',
+                min_samples_leaf=5
+            ),
+            __params,
+            resource='n_estimators',
+            # two candidates at 250 trees, then the winner at 500
+            factor=2,
+            min_resources='exhaust',
+            max_resources=500
+        )
+        model_pkl = f'{tmpdir}/RFC.joblib'
 
 @dataclass
 class PitchGBC(PitchGuessPost):
     # this took too long for gridsearch
     model_name = 'Gradient Boosting'
     model = GradientBoostingClassifier(random_state=random_state)
-    model_pkl = f'{tmpdir}/GBC.pkl'
+    model_pkl = f'{tmpdir}/GBC.joblib'
 
 @dataclass
 class PitchKNN(PitchGuessPost):
-    __params = {
-        'n_neighbors': [5, 10, 15],
-        'weights': ['uniform', 'distance'],
-        'metric': ['euclidean']
-    }
     model_name = 'K-Nearest Neighbor'
-    model = _get_grid_search(KNeighborsClassifier(), __params)
-    model_pkl = f'{tmpdir}/KNN.pkl'
+    if _HAS_HNSW:
+        __params = {
+            'n_neighbors': [5, 10, 15],
+            'ef': [50, 100, 200],
+            'M': [8, 16, 32]
+        }
+        model = _get_grid_search(ANNClassifier(), __params)
+        model_pkl = f'{tmpdir}/ANN.joblib'
+    else:
+        __params = {
+            'n_neighbors': [5, 10, 15],
+            'weights': ['uniform', 'distance'],
+            'metric': ['euclidean']
+        }
+        model = _get_grid_search(KNeighborsClassifier(), __params)
+        model_pkl = f'{tmpdir}/KNN.joblib'
 
 def get_experiments():
     return {